@@ -1,16 +1,34 @@
 """Extracts data from S3 Bucket"""
 
+from __future__ import annotations
+
 import os
 import logging
-import json
 import datetime
-from httpx import Client
+import gzip
+import time
+import threading
+from collections import Counter, OrderedDict
+from typing import Iterable, TYPE_CHECKING
+from concurrent.futures import ThreadPoolExecutor
+import ijson
+import ahocorasick
+import numpy as np
 import pandas as pd
 from boto3 import client
+from botocore.config import Config
 from dotenv import load_dotenv
-from pytrends.request import TrendReq
 
-load_dotenv(".env")
+if TYPE_CHECKING:
+    from pytrends.request import TrendReq
+
+REQUIRED_ENV_VARS = ("AWS_ACCESS_KEY_ID", "AWS_SECRET_ACCESS_KEY", "S3_BUCKET_NAME")
+S3_MAX_WORKERS = 16
+PYTRENDS_MAX_WORKERS = 8
+SUGGESTIONS_TTL_SECONDS = 3600
+SUGGESTIONS_CACHE_MAXSIZE = 1024
+SUGGESTIONS_CACHE = OrderedDict()
+SUGGESTIONS_CACHE_LOCK = threading.Lock()
 
 logging.basicConfig(
     level=logging.INFO,
@@ -19,6 +37,15 @@ logging.basicConfig(
 )
 
 
+def load_environment() -> None:
+    """Loads the .env file unless every variable extract needs is already set"""
+    if not all(os.environ.get(variable) for variable in REQUIRED_ENV_VARS):
+        load_dotenv(".env")
+
+
+load_environment()
+
+
 def s3_connection() -> client:
     """Connects to an S3 and configs S3 Connection"""
     try:
@@ -27,64 +54,136 @@ def s3_connection() -> client:
 
         if not aws_access_key or not aws_secret_key:
             logging.error("Missing required AWS credentials in .env file.")
-        s3 = client("s3")
+        s3 = client("s3", config=Config(tcp_keepalive=True,
+                                          max_pool_connections=2 * S3_MAX_WORKERS))
     except ConnectionError as e:
         logging.error('An error occurred attempting to connect to S3: %s', e)
         return None
     return s3
 
 
+def build_keyword_automaton(topic: list[str]) -> ahocorasick.Automaton:
+    """Compiles the keywords of a topic into a single Aho-Corasick automaton
+    that reports the index of each matched keyword. An empty keyword can't be
+    stored in the automaton, so it is left out and matched separately"""
+    automaton = ahocorasick.Automaton()
+    for keyword_id, keyword in enumerate(dict.fromkeys(topic)):
+        if keyword:
+            automaton.add_word(keyword, keyword_id)
+    automaton.make_automaton()
+    return automaton
+
+
+def topic_sentiment_analysis(topic: list[str], posts: Iterable[tuple],
+                             automaton: ahocorasick.Automaton = None) -> dict:
+    """Calculates the average sentiment and mentions of every keyword in a single
+    pass over the (text, sentiment) pairs of a .json file"""
+    keywords = list(dict.fromkeys(topic))
+    if not keywords:
+        return {}
+    if automaton is None:
+        automaton = build_keyword_automaton(keywords)
+
+    # '' is a substring of every text, so an empty keyword matches every post
+    always_matched = {keywords.index('')} if '' in keywords else set()
+    has_words = automaton.kind == ahocorasick.AHOCORASICK
+
+    keyword_ids = []
+    sentiments = []
+    for text, sentiment in posts:
+        matched_ids = set(always_matched)
+        if has_words:
+            matched_ids.update(keyword_id for _, keyword_id in automaton.iter(text))
+        if matched_ids:
+            keyword_ids.extend(matched_ids)
+            sentiments.extend(
+                [sentiment['Sentiment Score']['compound']] * len(matched_ids))
+
+    keyword_ids = np.asarray(keyword_ids, dtype=np.intp)
+    total_sentiment = np.bincount(keyword_ids, weights=np.asarray(sentiments, dtype=np.float64),
+                                  minlength=len(keywords))
+    mentions = np.bincount(keyword_ids, minlength=len(keywords))
+    average_sentiment = total_sentiment / np.maximum(mentions, 1)
+
+    return {keyword: (float(average_sentiment[keyword_id]), int(mentions[keyword_id]))
+            for keyword_id, keyword in enumerate(keywords)}
+
+
 def average_sentiment_analysis(keyword: str, file_data: dict) -> tuple:
     """Calculates the average sentiment for a keyword in a .json file"""
-    total_sentiment = 0
-    mentions = 0
-    for text, sentiment in file_data.items():
-        if keyword in text:
-            total_sentiment += sentiment['Sentiment Score']['compound']
-            mentions += 1
-    if mentions == 0:
-        return (total_sentiment, mentions)
-    return total_sentiment/mentions, mentions
-
-
-def extract_s3_data(s3: Client, bucket: str, topic: list[str]) -> pd.DataFrame:
-    """Extracts relevant data from an S3 Bucket for the past 7 days."""
-    today = datetime.datetime.now()
-    date_list = [(today - datetime.timedelta(days=i)).strftime("%Y-%m-%d")
-                 for i in range(7)]
+    return topic_sentiment_analysis([keyword], file_data.items())[keyword]
 
-    sentiment_and_mention_data = []
 
-    for date in date_list:
-        prefix = f"bluesky/{date}/"
-        response = s3.list_objects_v2(
-            Bucket=bucket, Prefix=prefix, Delimiter='/')
+def list_hourly_files(s3: client, bucket: str, date: str) -> list[tuple]:
+    """Lists the hourly .json files stored in an S3 Bucket for a given date"""
+    prefix = f"bluesky/{date}/"
+    paginator = s3.get_paginator('list_objects_v2')
 
-        if 'Contents' in response:
-            for obj in response['Contents']:
-                key = obj['Key']
-                hour = key.split("/")[-1].split(".")[0]
+    hourly_files = []
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix, Delimiter='/'):
+        for obj in page.get('Contents', []):
+            key = obj['Key']
+            file_name = key[len(prefix):]
 
-                if key.endswith('.json') and key.count('/') == prefix.count('/'):
-                    file_obj = s3.get_object(Bucket=bucket, Key=key)
-                    file_content = json.loads(
-                        file_obj['Body'].read().decode('utf-8'))
+            if '/' not in file_name and file_name.endswith(('.json', '.json.gz')):
+                hour = file_name.partition('.')[0]
+                hourly_files.append((f"{date} {hour}", key))
 
-                    for keyword in topic:
-                        sentiment_and_mentions = average_sentiment_analysis(
-                            keyword, file_content)
+    if not hourly_files:
+        logging.info("No files found in the folder for date %s.", date)
+    return hourly_files
 
-                        sentiment_and_mention_data.append({
-                            'Date and Hour': f"{date} {hour}",
-                            'Keyword': keyword,
-                            'Average Sentiment': sentiment_and_mentions[0],
-                            'Total Mentions': sentiment_and_mentions[1]
-                        })
-        else:
-            logging.info(f"No files found in the folder for date {date}.")
 
-    if sentiment_and_mention_data:
-        return pd.DataFrame(sentiment_and_mention_data)
+def analyse_hourly_file(s3: client, bucket: str, key: str, topic: list[str],
+                        automaton: ahocorasick.Automaton) -> dict:
+    """Streams an hourly .json file from S3 and analyses it for every keyword"""
+    logging.debug("Analysing hourly file %s", key)
+    file_obj = s3.get_object(Bucket=bucket, Key=key)
+    body = file_obj['Body']
+    if file_obj.get('ContentEncoding') == 'gzip' or key.endswith('.gz'):
+        body = gzip.GzipFile(fileobj=body)
+    file_content = ijson.kvitems(body, '', use_float=True)
+    return topic_sentiment_analysis(topic, file_content, automaton)
+
+
+def extract_s3_data(s3: client, bucket: str, topic: list[str]) -> pd.DataFrame:
+    """Extracts relevant data from an S3 Bucket for the past 7 days."""
+    today = datetime.datetime.now()
+    date_list = [(today - datetime.timedelta(days=i)).strftime("%Y-%m-%d")
+                 for i in range(7)]
+
+    automaton = build_keyword_automaton(topic)
+    with ThreadPoolExecutor(max_workers=S3_MAX_WORKERS) as executor:
+        daily_listings = [executor.submit(list_hourly_files, s3, bucket, date)
+                          for date in date_list]
+
+        hourly_analyses = []
+        for daily_listing in daily_listings:
+            for date_and_hour, key in daily_listing.result():
+                hourly_analyses.append((date_and_hour, executor.submit(
+                    analyse_hourly_file, s3, bucket, key, topic, automaton)))
+
+        date_and_hours, keywords, average_sentiments, total_mentions = [], [], [], []
+        keyword_mentions = Counter()
+        for date_and_hour, hourly_analysis in hourly_analyses:
+            for keyword, (average_sentiment, mentions) in hourly_analysis.result().items():
+                date_and_hours.append(date_and_hour)
+                keywords.append(keyword)
+                average_sentiments.append(average_sentiment)
+                total_mentions.append(mentions)
+                keyword_mentions[keyword] += mentions
+
+    for keyword, mentions in keyword_mentions.items():
+        logging.info("Found %d mentions of %s in %d hourly files.",
+                     mentions, keyword, len(hourly_analyses))
+
+    if keywords:
+        return pd.DataFrame({
+            'Date and Hour': date_and_hours,
+            'Keyword': pd.Categorical(keywords, categories=list(dict.fromkeys(topic))),
+            'Average Sentiment': np.asarray(average_sentiments, dtype=np.float64),
+            'Total Mentions': np.asarray(total_mentions, dtype=np.int64)
+        })
 
     logging.info("No files found in the past 7 days.")
     raise ValueError("No files found in the past 7 days.")
@@ -92,12 +191,34 @@ def extract_s3_data(s3: Client, bucket: str, topic: list[str]) -> pd.DataFrame:
 
 def initialize_trend_request() -> TrendReq:
     """Initialize and return a TrendReq object."""
+    from pytrends.request import TrendReq  # pylint: disable=import-outside-toplevel
     return TrendReq()
 
 
 def fetch_suggestions(pytrend: TrendReq, keyword: str) -> list[dict]:
-    """Fetch and print suggestions for a given keyword."""
-    return pytrend.suggestions(keyword=keyword)
+    """Fetch suggestions for a given keyword, reusing any fetched in the last hour."""
+    with SUGGESTIONS_CACHE_LOCK:
+        cached = SUGGESTIONS_CACHE.get(keyword)
+        if cached is not None:
+            if time.monotonic() - cached[0] < SUGGESTIONS_TTL_SECONDS:
+                SUGGESTIONS_CACHE.move_to_end(keyword)
+                return cached[1]
+            del SUGGESTIONS_CACHE[keyword]
+
+    suggestions = pytrend.suggestions(keyword=keyword)
+
+    with SUGGESTIONS_CACHE_LOCK:
+        SUGGESTIONS_CACHE[keyword] = (time.monotonic(), suggestions)
+        SUGGESTIONS_CACHE.move_to_end(keyword)
+        while len(SUGGESTIONS_CACHE) > SUGGESTIONS_CACHE_MAXSIZE:
+            SUGGESTIONS_CACHE.popitem(last=False)
+    return suggestions
+
+
+def fetch_related_terms(pytrend: TrendReq, keyword: str) -> str:
+    """Fetch the suggestions for a keyword as a comma separated string."""
+    return ",".join([suggestion['title']
+                     for suggestion in fetch_suggestions(pytrend, keyword)])
 
 
 def main(topic: list[str]) -> pd.DataFrame:
@@ -109,9 +230,11 @@ def main(topic: list[str]) -> pd.DataFrame:
     extracted_dataframe = extract_s3_data(s3, bucket, topic)
 
     pytrend = initialize_trend_request()
-    for keyword in topic:
-        extracted_dataframe.loc[extracted_dataframe['Keyword'] == keyword,
-                                'Related Terms'] = ",".join([suggestion['title']
-                                                             for suggestion in fetch_suggestions(pytrend, keyword)])
+    with ThreadPoolExecutor(max_workers=min(len(topic), PYTRENDS_MAX_WORKERS)) as executor:
+        related_terms = dict(zip(topic, executor.map(
+            lambda keyword: fetch_related_terms(pytrend, keyword), topic)))
+
+    extracted_dataframe['Related Terms'] = extracted_dataframe['Keyword'].astype(str).map(
+        related_terms)
     return extracted_dataframe
 
@@ -4,6 +4,7 @@
 import os
 import logging
 import json
+import gzip
 from unittest.mock import patch, MagicMock, ANY
 import datetime
 from io import BytesIO
@@ -11,8 +12,11 @@ import pandas as pd
 import pandas.testing as pdt
 import pytest
 from botocore.config import Config
-from extract import (s3_connection, average_sentiment_analysis,
-                     extract_s3_data, initialize_trend_request, fetch_suggestions, main)
+import extract
+from extract import (s3_connection, average_sentiment_analysis, topic_sentiment_analysis,
+                     build_keyword_automaton, list_hourly_files, analyse_hourly_file,
+                     extract_s3_data, initialize_trend_request, fetch_suggestions,
+                     fetch_related_terms, load_environment, main)
 
 
 @pytest.fixture
@@ -22,6 +26,14 @@ def aws_env_vars():
         yield
 
 
+@pytest.fixture(autouse=True)
+def clear_suggestions_cache():
+    """Empties the pytrends suggestions cache between tests."""
+    extract.SUGGESTIONS_CACHE.clear()
+    yield
+    extract.SUGGESTIONS_CACHE.clear()
+
+
 @pytest.fixture
 def file_data():
     """Fixture that provides a common data dictionary for sentiment analysis tests."""
@@ -32,12 +44,31 @@ def file_data():
     }
 
 
+@patch('extract.load_dotenv')
+def test_load_environment_skips_env_file_when_set(mock_load_dotenv, aws_env_vars):
+    """Test the .env file isn't read when every required variable is set."""
+    load_environment()
+    mock_load_dotenv.assert_not_called()
+
+
+@patch.dict(os.environ, {"AWS_ACCESS_KEY_ID": "fake_access_key",
+                         "AWS_SECRET_ACCESS_KEY": "fake_secret_key"}, clear=True)
+@patch('extract.load_dotenv')
+def test_load_environment_reads_env_file_for_missing_bucket(mock_load_dotenv):
+    """Test the .env file is still read when only the AWS credentials are set."""
+    load_environment()
+    mock_load_dotenv.assert_called_once_with(".env")
+
+
 @patch('extract.client')
 def test_successful_s3_connection(mock_client, aws_env_vars):
     """Test the successful connection to an S3 client without real-world side effects."""
 
     s3_connection()
-    mock_client.assert_called_once_with('s3')
+    mock_client.assert_called_once_with('s3', config=ANY)
+    config = mock_client.call_args.kwargs['config']
+    assert isinstance(config, Config)
+    assert config.tcp_keepalive is True
 
 
 @patch.dict(os.environ, {}, clear=True)
@@ -64,7 +95,7 @@ def test_s3_connection_connection_error(mock_client, caplog):
     assert 'An error occurred attempting to connect to S3:' in caplog.text
 
 
-@patch('extract.TrendReq')
+@patch('pytrends.request.TrendReq')
 def test_initialize_trend_success(mock_trendreq):
     """Test successful initialisation of trend request."""
     mock_trendreq_instance = MagicMock()
@@ -96,6 +127,44 @@ def test_average_sentiment_analysis_no_mentions(file_data):
     assert mentions == 0
 
 
+def test_topic_sentiment_analysis_multiple_keywords(file_data):
+    """Test every keyword in a topic is analysed in a single pass"""
+    topic = ['python', 'coding', 'sky']
+
+    result = topic_sentiment_analysis(topic, file_data.items())
+
+    assert result['python'] == (0.3, 3)
+    assert result['coding'] == (0.7, 1)
+    assert result['sky'] == (0, 0)
+
+
+def test_topic_sentiment_analysis_overlapping_keywords(file_data):
+    """Test keywords that overlap in a text are each counted once per text"""
+    topic = ['python', 'python is', 'thon']
+
+    result = topic_sentiment_analysis(topic, file_data.items())
+
+    assert result['python'] == (0.3, 3)
+    assert result['python is'] == (0.5, 1)
+    assert result['thon'] == (0.3, 3)
+
+
+def test_average_sentiment_analysis_empty_keyword(file_data):
+    """Test an empty keyword matches every post, as a substring check would"""
+    avg_sentiment, mentions = average_sentiment_analysis('', file_data)
+
+    assert avg_sentiment == pytest.approx(0.3)
+    assert mentions == 3
+
+
+def test_topic_sentiment_analysis_empty_keyword_in_topic(file_data):
+    """Test an empty keyword alongside others matches every post"""
+    result = topic_sentiment_analysis(['coding', ''], file_data.items())
+
+    assert result['coding'] == (0.7, 1)
+    assert result[''] == pytest.approx((0.3, 3))
+
+
 def test_average_sentiment_analysis_file_empty():
     """Test case for when the file being searched is empty"""
     keyword = 'sky'
@@ -106,10 +175,56 @@ def test_average_sentiment_analysis_file_empty():
     assert mentions == 0
 
 
-@patch('extract.average_sentiment_analysis')
+def test_list_hourly_files_across_pages():
+    """Test hourly files are collected from every page of the listing"""
+    mock_s3 = MagicMock()
+    mock_s3.get_paginator.return_value.paginate.return_value = [
+        {'Contents': [{'Key': 'bluesky/2024-12-09/00.json'},
+                      {'Key': 'bluesky/2024-12-09/notes.txt'}]},
+        {'Contents': [{'Key': 'bluesky/2024-12-09/01.json.gz'}]},
+        {}]
+
+    result = list_hourly_files(mock_s3, 'bucket_name', '2024-12-09')
+
+    mock_s3.get_paginator.return_value.paginate.assert_called_once_with(
+        Bucket='bucket_name', Prefix='bluesky/2024-12-09/', Delimiter='/')
+    assert result == [('2024-12-09 00', 'bluesky/2024-12-09/00.json'),
+                      ('2024-12-09 01', 'bluesky/2024-12-09/01.json.gz')]
+
+
+def test_analyse_hourly_file_streams_body(file_data):
+    """Test an hourly file is read from S3 and analysed for every keyword"""
+    mock_s3 = MagicMock()
+    mock_s3.get_object.return_value = {
+        'Body': BytesIO(json.dumps(file_data).encode('utf-8'))}
+    topic = ['python', 'coding']
+
+    result = analyse_hourly_file(mock_s3, 'bucket_name', 'bluesky/2024-12-09/00.json',
+                                 topic, build_keyword_automaton(topic))
+
+    mock_s3.get_object.assert_called_once_with(
+        Bucket='bucket_name', Key='bluesky/2024-12-09/00.json')
+    assert result['python'] == pytest.approx((0.3, 3))
+    assert result['coding'] == (0.7, 1)
+
+
+def test_analyse_hourly_file_gzipped_body(file_data):
+    """Test a gzipped hourly file is decompressed while it streams"""
+    mock_s3 = MagicMock()
+    mock_s3.get_object.return_value = {
+        'Body': BytesIO(gzip.compress(json.dumps(file_data).encode('utf-8')))}
+    topic = ['python']
+
+    result = analyse_hourly_file(mock_s3, 'bucket_name', 'bluesky/2024-12-09/00.json.gz',
+                                 topic, build_keyword_automaton(topic))
+
+    assert result['python'] == pytest.approx((0.3, 3))
+
+
+@patch('extract.topic_sentiment_analysis')
 @patch('extract.datetime')
 @patch('extract.client')
-def test_extract_s3_success(mock_client, mock_datetime, mock_sentiment_analysis):
+def test_extract_s3_success(mock_client, mock_datetime, mock_sentiment_analysis, caplog):
     """Test successful extraction of data from s3 into pd.dataframe."""
     mock_datetime.datetime.now.return_value = datetime.datetime(2024, 12, 9)
     mock_datetime.timedelta = datetime.timedelta
@@ -117,14 +232,14 @@ def test_extract_s3_success(mock_client, mock_datetime, mock_sentiment_analysis)
     bucket_name = 'bucket_name'
     topics = ['python']
 
-    mock_client.list_objects_v2.side_effect = lambda Bucket, Prefix, Delimiter: (
+    mock_client.get_paginator.return_value.paginate.side_effect = lambda Bucket, Prefix, Delimiter: [(
         {'Contents': [{'Key': f'{Prefix}00.json', 'LastModified': datetime.datetime(
             2024, 12, 9, 1, 0, 1), 'Size': 1324861}]}
         if Prefix.startswith('bluesky/2024-12-09/') else
         {'Contents': [{'Key': f'{Prefix}00.json', 'LastModified': datetime.datetime(
             2024, 12, 8, 1, 0, 1), 'Size': 1324861}]}
         if Prefix.startswith('bluesky/2024-12-08/') else
-        {})
+        {})]
 
     mock_json_content = [{
         'python is great': {'Sentiment Score': {'compound': 0.5}},
@@ -138,10 +253,12 @@ def test_extract_s3_success(mock_client, mock_datetime, mock_sentiment_analysis)
     mock_client.get_object.side_effect = [
         {'Body': BytesIO(json.dumps(mock_json_content[i % 2]).encode('utf-8'))} for i in range(7)]
     mock_sentiment_analysis.side_effect = [
-        (0.6, 2) if i % 2 == 0 else (-0.45, 2) for i in range(7)
+        {'python': (0.6, 2)} if i % 2 == 0 else {'python': (-0.45, 2)} for i in range(7)
     ]
 
-    result = extract_s3_data(mock_client, bucket_name, topics)
+    with caplog.at_level(logging.INFO):
+        result = extract_s3_data(mock_client, bucket_name, topics)
+    assert 'Found 4 mentions of python in 2 hourly files.' in caplog.text
     assert not result.empty
     assert isinstance(result, pd.DataFrame)
     assert len(result) == 2
@@ -149,6 +266,9 @@ def test_extract_s3_success(mock_client, mock_datetime, mock_sentiment_analysis)
     assert 'Average Sentiment' in result.columns
     assert 'Total Mentions' in result.columns
     assert 'Date and Hour' in result.columns
+    assert isinstance(result['Keyword'].dtype, pd.CategoricalDtype)
+    assert result['Total Mentions'].dtype == 'int64'
+    mock_client.get_paginator.assert_called_with('list_objects_v2')
 
 
 @patch('datetime.datetime')
@@ -160,7 +280,7 @@ def test_extract_s3_no_files(mock_client, mock_datetime, caplog):
     bucket_name = 'bucket_name'
     topics = ['python']
 
-    mock_client.list_objects_v2.return_value = {}
+    mock_client.get_paginator.return_value.paginate.return_value = [{}]
     with caplog.at_level(logging.INFO):
         with pytest.raises(ValueError):
             extract_s3_data(mock_client, bucket_name, topics)
@@ -182,6 +302,7 @@ def test_main_success(mock_s3_conn, mock_extract_s3, mock_pytrend, mock_suggesti
             "Average Sentiment": -0.3, "Total Mentions": 2},
     ]
     extracted_df = pd.DataFrame(mock_data)
+    extracted_df['Keyword'] = pd.Categorical(extracted_df['Keyword'], categories=topic)
     mock_extract_s3.return_value = extracted_df
     mock_suggestions.return_value = [
         {'title': 'python tutorial'}, {'title': 'python programming'}]
@@ -193,6 +314,7 @@ def test_main_success(mock_s3_conn, mock_extract_s3, mock_pytrend, mock_suggesti
          "Related Terms": "python tutorial,python programming"}
     ]
     expected_df = pd.DataFrame(expected_data)
+    expected_df['Keyword'] = pd.Categorical(expected_df['Keyword'], categories=topic)
 
     result = main(topic)
     assert isinstance(result, pd.DataFrame)
@@ -205,7 +327,32 @@ def test_main_success(mock_s3_conn, mock_extract_s3, mock_pytrend, mock_suggesti
     pdt.assert_frame_equal(result, expected_df)
 
 
-@patch('extract.TrendReq')
+@patch('extract.fetch_suggestions')
+@patch('extract.initialize_trend_request')
+@patch('extract.extract_s3_data')
+@patch('extract.s3_connection')
+def test_main_related_terms_dtype_is_stable(mock_s3_conn, mock_extract_s3, mock_pytrend,
+                                           mock_suggestions, aws_env_vars):
+    """Test Related Terms keeps the same dtype whether or not keywords share terms."""
+    topic = ['python', 'java']
+    mock_suggestions.side_effect = lambda pytrend, keyword: {
+        'python': [{'title': 'python tutorial'}], 'java': [{'title': 'java jdk'}]}[keyword]
+    mock_extract_s3.return_value = pd.DataFrame({
+        'Keyword': pd.Categorical(topic, categories=topic)})
+    distinct_terms = main(topic)['Related Terms']
+
+    mock_suggestions.side_effect = lambda pytrend, keyword: []
+    mock_extract_s3.return_value = pd.DataFrame({
+        'Keyword': pd.Categorical(topic, categories=topic)})
+    shared_terms = main(topic)['Related Terms']
+
+    assert not isinstance(distinct_terms.dtype, pd.CategoricalDtype)
+    assert distinct_terms.dtype == shared_terms.dtype
+    assert list(distinct_terms) == ['python tutorial', 'java jdk']
+    assert list(shared_terms) == ['', '']
+
+
+@patch('pytrends.request.TrendReq')
 def test_fetch_suggestions(mock_trendreq):
     """Test function to ensure related words are returned successfully."""
 
@@ -222,3 +369,66 @@ def test_fetch_suggestions(mock_trendreq):
     mock_trendreq.return_value = mock_pytrend_instance
     result = fetch_suggestions(mock_pytrend_instance, keyword)
     assert result == mock_related_words
+
+
+@patch('extract.time')
+def test_fetch_suggestions_cached(mock_time):
+    """Test suggestions are reused within the TTL and refetched after it."""
+    mock_pytrend_instance = MagicMock()
+    mock_pytrend_instance.suggestions.return_value = [{'title': 'Goodfellas'}]
+
+    mock_time.monotonic.return_value = 0
+    fetch_suggestions(mock_pytrend_instance, 'good')
+    mock_time.monotonic.return_value = 60
+    result = fetch_suggestions(mock_pytrend_instance, 'good')
+
+    assert result == [{'title': 'Goodfellas'}]
+    mock_pytrend_instance.suggestions.assert_called_once_with(keyword='good')
+
+    mock_time.monotonic.return_value = 3600
+    fetch_suggestions(mock_pytrend_instance, 'good')
+    assert mock_pytrend_instance.suggestions.call_count == 2
+
+
+@patch('extract.SUGGESTIONS_CACHE_MAXSIZE', 2)
+def test_fetch_suggestions_cache_evicts_least_recent():
+    """Test the least recently used keyword is evicted once the cache is full."""
+    mock_pytrend_instance = MagicMock()
+    mock_pytrend_instance.suggestions.side_effect = lambda keyword: [{'title': keyword}]
+
+    fetch_suggestions(mock_pytrend_instance, 'good')
+    fetch_suggestions(mock_pytrend_instance, 'bad')
+    fetch_suggestions(mock_pytrend_instance, 'good')
+    fetch_suggestions(mock_pytrend_instance, 'ugly')
+
+    assert list(extract.SUGGESTIONS_CACHE) == ['good', 'ugly']
+
+    fetch_suggestions(mock_pytrend_instance, 'bad')
+    assert mock_pytrend_instance.suggestions.call_count == 4
+    assert list(extract.SUGGESTIONS_CACHE) == ['ugly', 'bad']
+
+
+@patch('extract.time')
+def test_fetch_suggestions_drops_expired_entry(mock_time):
+    """Test an expired entry is removed from the cache when it is looked up."""
+    mock_pytrend_instance = MagicMock()
+    mock_pytrend_instance.suggestions.side_effect = [[{'title': 'old'}], Exception("API down")]
+
+    mock_time.monotonic.return_value = 0
+    fetch_suggestions(mock_pytrend_instance, 'good')
+    mock_time.monotonic.return_value = 3600
+    with pytest.raises(Exception):
+        fetch_suggestions(mock_pytrend_instance, 'good')
+
+    assert 'good' not in extract.SUGGESTIONS_CACHE
+
+
+@patch('extract.fetch_suggestions')
+def test_fetch_related_terms(mock_suggestions):
+    """Test suggestion titles are joined into a comma separated string."""
+    mock_suggestions.return_value = [
+        {'title': 'python tutorial'}, {'title': 'python programming'}]
+
+    result = fetch_related_terms(MagicMock(), 'python')
+
+    assert result == "python tutorial,python programming"